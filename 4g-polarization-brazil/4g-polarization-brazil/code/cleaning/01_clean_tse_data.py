@@ -16,14 +16,40 @@ Input:
   
 Output:
   - data/processed/tse_cleaned.csv
+  - data/processed/tse_cleaned/ano=YYYY/ (Parquet dataset, one partition per year)
+  - data/processed/votes_YYYY.parquet (cache of filtered TSE votes)
 """
 
 import pandas as pd
 import numpy as np
 from pathlib import Path
 import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from typing import Dict, List
 
+try:
+    from numba import njit, prange, set_num_threads
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+try:
+    import polars as pl
+    POLARS_AVAILABLE = True
+except ImportError:
+    POLARS_AVAILABLE = False
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+    import pyarrow.dataset as ds
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -36,6 +62,18 @@ RAW_DATA_PATH = Path("data/raw")
 PROCESSED_DATA_PATH = Path("data/processed")
 ELECTION_YEARS = [2010, 2014, 2018, 2022]
 CHUNK_SIZE = 100_000
+ARROW_BLOCK_SIZE = 16 << 20  # bytes per parser block
+MAX_WORKERS = 4
+OUTPUT_COLUMNS = ['cod_municipio', 'ano', 'polarizacao_er', 'num_partidos', 'total_votos']
+TSE_COLUMNS = ['DS_CARGO', 'NR_TURNO', 'CD_MUNICIPIO', 'SG_PARTIDO', 'QT_VOTOS']
+VOTE_COLUMNS = ['CD_MUNICIPIO', 'SG_PARTIDO', 'QT_VOTOS']
+TSE_DTYPES = {
+    'DS_CARGO': 'category',
+    'NR_TURNO': 'int8',
+    'CD_MUNICIPIO': 'int32',
+    'SG_PARTIDO': 'category',
+    'QT_VOTOS': 'int32'
+}
 
 # Party ideology additions for 2018 (missing from original Zucco & Power)
 PARTY_IDEOLOGY_2018_ADDITIONS = {
@@ -73,32 +111,187 @@ def esteban_ray_index(
     Esteban, J., & Ray, D. (1994). On the measurement of polarization. 
     Econometrica, 62(4), 819-851.
     """
+    # Shares go to single precision to halve memory traffic; ideology scores
+    # and the s ** (1 + alpha) weights stay double to keep rounding down
+    vote_shares = np.asarray(vote_shares).astype(np.float32, copy=False)
+    ideologies = np.asarray(ideologies).astype(np.float64, copy=False)
+    
     # Remove parties with zero vote share
     mask = vote_shares > 0
     vote_shares = vote_shares[mask]
     ideologies = ideologies[mask]
     
+    # No votes at all: nothing to polarize
+    if vote_shares.size == 0:
+        return 0.0
+    
     # Normalize vote shares (in case they don't sum to exactly 1)
     vote_shares = vote_shares / vote_shares.sum()
     
-    # Calculate pairwise polarization
-    polarization = 0
-    n = len(vote_shares)
+    # Sort by ideology so sum_j p_j |y_i - y_j| follows from prefix sums
+    # (O(n log n) time and O(n) memory instead of an n x n distance matrix)
+    order = np.argsort(ideologies, kind='stable')
+    vote_shares = vote_shares[order]
+    ideologies = ideologies[order]
+    
+    # Prefix sums in float64 (the difference below cancels heavily), with a
+    # leading zero so cum_p[k] covers the first k parties
+    cum_p = np.concatenate(([0.0], np.cumsum(vote_shares, dtype=np.float64)))
+    cum_py = np.concatenate(
+        ([0.0], np.cumsum(vote_shares.astype(np.float64) * ideologies))
+    )
     
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                identification = vote_shares[i] ** (1 + alpha)
-                alienation = vote_shares[j]
-                distance = abs(ideologies[i] - ideologies[j])
-                polarization += identification * alienation * distance
+    # Parties tied on ideology are at distance zero, so only those strictly
+    # below [0, lo) and strictly above [hi, n) enter the sums
+    lo = np.searchsorted(ideologies, ideologies, side='left')
+    hi = np.searchsorted(ideologies, ideologies, side='right')
+    alienation = (
+        ideologies * (cum_p[lo] - (cum_p[-1] - cum_p[hi])) -
+        (cum_py[lo] - (cum_py[-1] - cum_py[hi]))
+    )
+    # Alienation is a sum of distances, so anything below zero is rounding
+    alienation = np.maximum(alienation, 0.0)
     
+    identification = vote_shares.astype(np.float64) ** (1.0 + alpha)
+    polarization = float(identification @ alienation)
+
     # Normalization constant K (ensures bounded measure)
     K = 1.0  # Simplified; can adjust based on scale preferences
     
     return K * polarization
 
 
+def _esteban_ray_segments(
+    shares: np.ndarray,
+    identification: np.ndarray,
+    ideologies: np.ndarray,
+    starts: np.ndarray,
+    counts: np.ndarray,
+    out: np.ndarray
+) -> None:
+    """
+    Esteban-Ray kernel over contiguous segments of flat arrays
+
+    Segment g spans shares[starts[g]:starts[g] + counts[g]] and must be
+    sorted by ideology; shares are assumed already normalized within each
+    segment and identification holds shares ** (1 + alpha). Results go to
+    out[g].
+    """
+    for g in prange(len(starts)):
+        s = starts[g]
+        n = counts[g]
+        # Running sums stay in float64 since the alienation term cancels heavily
+        total_p = 0.0
+        total_py = 0.0
+        for i in range(s, s + n):
+            total_p += shares[i]
+            total_py += np.float64(shares[i]) * ideologies[i]
+        
+        # With sorted ideologies, sum_j p_j |y_i - y_j| is a prefix-sum
+        # expression, so each segment costs O(n) instead of O(n^2). Rows
+        # tied on ideology are at distance zero from each other, so they are
+        # handled as one block and only rows strictly below (cum_*) or
+        # strictly above (above_*) it enter the sums
+        cum_p = 0.0
+        cum_py = 0.0
+        acc = 0.0
+        i = s
+        while i < s + n:
+            block_p = 0.0
+            block_py = 0.0
+            k = i
+            while k < s + n and ideologies[k] == ideologies[i]:
+                block_p += shares[k]
+                block_py += np.float64(shares[k]) * ideologies[k]
+                k += 1
+            above_p = total_p - cum_p - block_p
+            above_py = total_py - cum_py - block_py
+            alienation = (
+                ideologies[i] * (cum_p - above_p) - (cum_py - above_py)
+            )
+            # A sum of distances can't be negative; clamp rounding noise
+            alienation = max(alienation, 0.0)
+            for r in range(i, k):
+                acc += identification[r] * alienation
+            cum_p += block_p
+            cum_py += block_py
+            i = k
+        out[g] = acc
+
+
+if NUMBA_AVAILABLE:
+    _esteban_ray_segments = njit(parallel=True, cache=True)(_esteban_ray_segments)
+
+
+def esteban_ray_by_segment(
+    shares: np.ndarray,
+    ideologies: np.ndarray,
+    starts: np.ndarray,
+    counts: np.ndarray,
+    alpha: float = 1.6
+) -> np.ndarray:
+    """
+    Calculate Esteban-Ray index for every segment of flat, grouped arrays
+    
+    Rows within each segment must be sorted by ideology. Uses the Numba
+    kernel when available, otherwise processes all segments with the same
+    number of rows together as (G, n) arrays.
+    """
+    out = np.empty(len(starts), dtype=np.float64)
+    
+    # float32 shares; identification, ideologies and the running sums
+    # stay float64
+    shares = np.ascontiguousarray(shares, dtype=np.float32)
+    ideologies = np.ascontiguousarray(ideologies, dtype=np.float64)
+    # One vectorized pow over all rows instead of one per party pair
+    identification = shares.astype(np.float64) ** (1.0 + alpha)
+
+    if NUMBA_AVAILABLE:
+        _esteban_ray_segments(
+            shares,
+            identification,
+            ideologies,
+            starts.astype(np.int64),
+            counts.astype(np.int64),
+            out
+        )
+        return out
+
+    # Segments of equal size form a rectangular block, so each bucket is a
+    # handful of array operations instead of a Python call per municipality
+    for n in np.unique(counts):
+        groups = np.flatnonzero(counts == n)
+        rows = starts[groups][:, None] + np.arange(n)
+        
+        p = shares[rows]
+        y = ideologies[rows]
+        zero = np.zeros((len(groups), 1))
+        cum_p = np.hstack([zero, np.cumsum(p, axis=1, dtype=np.float64)])
+        cum_py = np.hstack([zero, np.cumsum(p.astype(np.float64) * y, axis=1)])
+        
+        # As in esteban_ray_index, rows tied on ideology are left out: lo and
+        # hi bound the block of rows sharing each row's ideology
+        positions = np.broadcast_to(np.arange(n), y.shape)
+        block_start = np.ones(y.shape, dtype=bool)
+        block_start[:, 1:] = y[:, 1:] != y[:, :-1]
+        block_end = np.ones(y.shape, dtype=bool)
+        block_end[:, :-1] = block_start[:, 1:]
+        lo = np.maximum.accumulate(np.where(block_start, positions, 0), axis=1)
+        hi = np.minimum.accumulate(
+            np.where(block_end, positions + 1, n)[:, ::-1], axis=1
+        )[:, ::-1]
+        
+        below_p = np.take_along_axis(cum_p, lo, axis=1)
+        below_py = np.take_along_axis(cum_py, lo, axis=1)
+        above_p = cum_p[:, -1:] - np.take_along_axis(cum_p, hi, axis=1)
+        above_py = cum_py[:, -1:] - np.take_along_axis(cum_py, hi, axis=1)
+        alienation = np.maximum(
+            y * (below_p - above_p) - (below_py - above_py), 0.0
+        )
+        out[groups] = np.einsum('gi,gi->g', identification[rows], alienation)
+    return out
+
+
 def load_party_ideologies() -> pd.DataFrame:
     """
     Load and prepare party ideology classifications
@@ -123,6 +316,13 @@ def load_party_ideologies() -> pd.DataFrame:
     return ideology_df
 
 
+def _polars_to_pandas(df: "pl.DataFrame") -> pd.DataFrame:
+    """
+    Convert a polars frame column by column through numpy (no pyarrow needed)
+    """
+    return pd.DataFrame({col: df[col].to_numpy() for col in df.columns})
+
+
 def load_tse_data(year: int) -> pd.DataFrame:
     """
     Load TSE voting data for a given year with proper encoding
@@ -135,8 +335,73 @@ def load_tse_data(year: int) -> pd.DataFrame:
     logger.info(f"Loading TSE data for {year}...")
     
     file_path = RAW_DATA_PATH / f"votacao_candidato_munzona_{year}.csv"
+    parquet_path = PROCESSED_DATA_PATH / f"votes_{year}.parquet"
+    
+    # Reuse the filtered Parquet cache unless the raw CSV is newer
+    if (POLARS_AVAILABLE or PYARROW_AVAILABLE) and parquet_path.exists() and (
+        not file_path.exists() or
+        parquet_path.stat().st_mtime >= file_path.stat().st_mtime
+    ):
+        if POLARS_AVAILABLE:
+            df = _polars_to_pandas(pl.read_parquet(parquet_path, columns=VOTE_COLUMNS))
+        else:
+            df = pd.read_parquet(parquet_path, columns=VOTE_COLUMNS)
+        logger.info(f"  Loaded {len(df):,} cached records for {year}")
+        return df
+    
+    if POLARS_AVAILABLE:
+        # Lazy multithreaded scan: the filter and column selection are pushed
+        # into the CSV reader. TSE files are Latin1, which polars cannot
+        # decode natively; the columns kept here are ASCII, so a lossy UTF-8
+        # read leaves them intact.
+        votes = (
+            pl.scan_csv(
+                file_path,
+                separator=';',
+                encoding='utf8-lossy',
+                schema_overrides={
+                    'NR_TURNO': pl.Int8,
+                    'CD_MUNICIPIO': pl.Int32,
+                    'QT_VOTOS': pl.Int32
+                }
+            )
+            .filter(
+                (pl.col('DS_CARGO') == 'Presidente') &
+                (pl.col('NR_TURNO') == 1)
+            )
+            .select(VOTE_COLUMNS)
+            .collect()
+        )
+        votes.write_parquet(parquet_path, compression='snappy')
+        
+        df = _polars_to_pandas(votes)
+        logger.info(f"  Loaded {len(df):,} records for {year}")
+        return df
     
     # TSE files typically use Latin1 encoding with semicolon separator
+    if PYARROW_AVAILABLE:
+        # Multithreaded Arrow parser, reading only the columns we need
+        table = pacsv.read_csv(
+            file_path,
+            read_options=pacsv.ReadOptions(
+                encoding='latin1',
+                block_size=ARROW_BLOCK_SIZE
+            ),
+            parse_options=pacsv.ParseOptions(delimiter=';'),
+            convert_options=pacsv.ConvertOptions(include_columns=TSE_COLUMNS)
+        )
+        
+        # Filter for presidential elections, first round
+        mask = pc.and_(
+            pc.equal(table['DS_CARGO'], 'Presidente'),
+            pc.equal(table['NR_TURNO'], 1)
+        )
+        df = table.filter(mask).select(VOTE_COLUMNS).to_pandas()
+        logger.info(f"  Loaded {len(df):,} records for {year}")
+        
+        df.to_parquet(parquet_path, compression='snappy', index=False)
+        return df
+    
     try:
         # Try chunked reading for memory efficiency
         chunks = []
@@ -144,15 +409,17 @@ def load_tse_data(year: int) -> pd.DataFrame:
             file_path,
             encoding='latin1',
             sep=';',
+            usecols=TSE_COLUMNS,
+            dtype=TSE_DTYPES,
             chunksize=CHUNK_SIZE,
             low_memory=False
         ):
             # Filter for presidential elections, first round
-            chunk = chunk[
-                (chunk['DS_CARGO'] == 'Presidente') & 
-                (chunk['NR_TURNO'] == 1)
-            ]
-            chunks.append(chunk)
+            mask = (
+                (chunk['DS_CARGO'].values == 'Presidente') &
+                (chunk['NR_TURNO'].values == 1)
+            )
+            chunks.append(chunk.loc[mask, VOTE_COLUMNS])
         
         df = pd.concat(chunks, ignore_index=True)
         logger.info(f"  Loaded {len(df):,} records for {year}")
@@ -184,55 +451,145 @@ def calculate_municipality_polarization(
     """
     logger.info(f"Calculating polarization for {year}...")
     
-    # Get relevant ideology scores for this year
-    ideology_year = ideology_df[ideology_df['year'] == year].copy()
-    
-    # Merge votes with ideology scores
-    merged = votes_df.merge(
-        ideology_year[['party', 'ideology']],
-        left_on='SG_PARTIDO',
-        right_on='party',
-        how='left'
-    )
+    # Get relevant ideology scores for this year as a plain dict lookup
+    # (the table has only ~30 rows, so no DataFrame copy is needed)
+    in_year = ideology_df['year'] == year
+    ideo_map = dict(zip(
+        ideology_df.loc[in_year, 'party'],
+        ideology_df.loc[in_year, 'ideology']
+    ))
     
     # Check for missing ideologies
-    missing = merged[merged['ideology'].isna()]['SG_PARTIDO'].unique()
+    missing = pd.Index(votes_df['SG_PARTIDO'].unique()).dropna().difference(
+        list(ideo_map)
+    ).tolist()
     if len(missing) > 0:
         logger.warning(f"  Missing ideology for parties: {missing}")
         logger.warning(f"  These votes will be excluded from polarization calculation")
     
+    merged = votes_df.assign(
+        ideology=votes_df['SG_PARTIDO'].map(ideo_map).astype('float64')
+    )
+    
     # Remove votes for parties without ideology scores
     merged = merged.dropna(subset=['ideology'])
     
     # Calculate vote shares by municipality
-    municipality_totals = merged.groupby('CD_MUNICIPIO')['QT_VOTOS'].sum()
-    merged['vote_share'] = merged.groupby('CD_MUNICIPIO')['QT_VOTOS'].transform(
-        lambda x: x / x.sum()
+    # (one groupby, reused for the shares and for total_votos)
+    municipality_totals = merged.groupby(
+        'CD_MUNICIPIO', sort=False, observed=True
+    )['QT_VOTOS'].sum()
+    # Municipalities with no votes keep zero shares (polarization 0.0, not NaN)
+    row_totals = merged['CD_MUNICIPIO'].map(municipality_totals).values.astype(np.float64)
+    merged['vote_share'] = np.divide(
+        merged['QT_VOTOS'].values,
+        row_totals,
+        out=np.zeros(len(merged), dtype=np.float64),
+        where=row_totals > 0
     )
     
-    # Calculate polarization for each municipality
-    polarization_results = []
-    
-    for municipio, group in merged.groupby('CD_MUNICIPIO'):
-        vote_shares = group['vote_share'].values
-        ideologies = group['ideology'].values
-        
-        er_index = esteban_ray_index(vote_shares, ideologies)
-        
-        polarization_results.append({
-            'cod_municipio': municipio,
-            'ano': year,
-            'polarizacao_er': er_index,
-            'num_partidos': len(group),
-            'total_votos': municipality_totals[municipio]
-        })
-    
-    result_df = pd.DataFrame(polarization_results)
+    # Sort by municipality so each one is a contiguous slice of the arrays,
+    # and by ideology within it as the segment kernel expects
+    merged = merged.sort_values(['CD_MUNICIPIO', 'ideology'], kind='stable')
+    municipios = merged['CD_MUNICIPIO'].values
+    shares = merged['vote_share'].values
+    ideologies = merged['ideology'].values
+
+    uniq, starts, counts = np.unique(
+        municipios, return_index=True, return_counts=True
+    )
+
+    # Calculate polarization for all municipalities in one pass
+    er_values = esteban_ray_by_segment(shares, ideologies, starts, counts)
+
+    # Build from typed column arrays (no per-row dicts or dtype inference)
+    n_municipios = len(uniq)
+    result_df = pd.DataFrame({
+        'cod_municipio': uniq,
+        'ano': np.full(n_municipios, year, dtype=np.int16),
+        'polarizacao_er': er_values,
+        'num_partidos': counts.astype(np.int32),
+        'total_votos': municipality_totals.loc[uniq].values.astype(np.int64)
+    })
     logger.info(f"  Calculated polarization for {len(result_df):,} municipalities")
     
     return result_df
 
 
+# Party ideologies shared with each worker process via _init_worker
+_worker_ideology_df = None
+
+
+def _init_worker(ideology_df: pd.DataFrame, threads_per_worker: int) -> None:
+    """
+    Store party ideologies once per worker process and cap its Numba threads
+    """
+    global _worker_ideology_df
+    _worker_ideology_df = ideology_df
+    
+    if NUMBA_AVAILABLE:
+        set_num_threads(threads_per_worker)
+
+
+def process_year(year: int) -> pd.DataFrame:
+    """
+    Load TSE data and calculate municipal polarization for one election year
+    
+    Runs in a worker process; expects _init_worker to have been called.
+    """
+    votes_df = load_tse_data(year)
+    return calculate_municipality_polarization(
+        votes_df,
+        _worker_ideology_df,
+        year
+    )
+
+
+def save_year_partition(polarization_df: pd.DataFrame, dataset_path: Path) -> None:
+    """
+    Write one year's results to its ano=YYYY partition of the Parquet dataset
+    
+    Replaces any partition left by a previous run for the same year.
+    """
+    table = pa.Table.from_pandas(polarization_df, preserve_index=False)
+    ds.write_dataset(
+        table,
+        dataset_path,
+        format='parquet',
+        partitioning=ds.partitioning(
+            pa.schema([('ano', pa.int16())]),
+            flavor='hive'
+        ),
+        existing_data_behavior='delete_matching'
+    )
+
+
+def export_dataset_csv(dataset_path: Path, output_path: Path) -> pd.DataFrame:
+    """
+    Write the partitioned dataset as one CSV sorted by municipality and year
+    
+    Returns the sorted results for the summary statistics.
+    """
+    dataset = ds.dataset(
+        dataset_path,
+        format='parquet',
+        partitioning=ds.partitioning(
+            pa.schema([('ano', pa.int16())]),
+            flavor='hive'
+        )
+    )
+    table = dataset.to_table(
+        columns=OUTPUT_COLUMNS,
+        filter=ds.field('ano').isin(ELECTION_YEARS)
+    ).sort_by([('cod_municipio', 'ascending'), ('ano', 'ascending')])
+    
+    # Written by pandas rather than Arrow's CSV writer, whose float format
+    # differs (0 vs 0.0, 0.00001 vs 1e-05) from the non-pyarrow path
+    final_df = table.to_pandas()
+    final_df.to_csv(output_path, index=False, encoding='utf-8')
+    return final_df
+
+
 def main():
     """
     Main execution function
@@ -247,31 +604,41 @@ def main():
     # Load party ideologies
     ideology_df = load_party_ideologies()
     
-    # Process each election year
-    all_results = []
-    
-    for year in ELECTION_YEARS:
-        # Load TSE data
-        votes_df = load_tse_data(year)
-        
-        # Calculate polarization
-        polarization_df = calculate_municipality_polarization(
-            votes_df, 
-            ideology_df, 
-            year
-        )
-        
-        all_results.append(polarization_df)
-    
-    # Combine all years
-    final_df = pd.concat(all_results, ignore_index=True)
-    
-    # Sort by municipality and year
-    final_df = final_df.sort_values(['cod_municipio', 'ano'])
-    
-    # Save processed data
     output_path = PROCESSED_DATA_PATH / "tse_cleaned.csv"
-    final_df.to_csv(output_path, index=False, encoding='utf-8')
+    dataset_path = PROCESSED_DATA_PATH / "tse_cleaned"
+    
+    # Process election years in parallel (each year is independent)
+    # Split the cores between workers so the Numba and polars thread pools
+    # in each process don't oversubscribe the machine
+    n_workers = min(MAX_WORKERS, len(ELECTION_YEARS))
+    threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+    
+    # polars sizes its pool at import from POLARS_MAX_THREADS, so workers are
+    # spawned fresh (forking a process with a live polars pool can deadlock)
+    os.environ.setdefault('POLARS_MAX_THREADS', str(threads_per_worker))
+    
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(ideology_df, threads_per_worker)
+    ) as executor:
+        results = executor.map(process_year, ELECTION_YEARS)
+        
+        if PYARROW_AVAILABLE:
+            # Stream each year into its Parquet partition as it finishes
+            for polarization_df in results:
+                save_year_partition(polarization_df, dataset_path)
+        else:
+            all_results = list(results)
+    
+    if PYARROW_AVAILABLE:
+        final_df = export_dataset_csv(dataset_path, output_path)
+    else:
+        # Combine all years, sorted by municipality and year
+        final_df = pd.concat(all_results, ignore_index=True)
+        final_df = final_df.sort_values(['cod_municipio', 'ano'])
+        final_df.to_csv(output_path, index=False, encoding='utf-8')
     
     logger.info("="*60)
     logger.info(f"Processing complete!")
@@ -0,0 +1,188 @@
+"""
+Checks for code/cleaning/01_clean_tse_data.py: the Esteban-Ray index
+against the original double-loop implementation, and the output files
+"""
+
+import importlib
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Import the script as a regular module so Numba's on-disk cache can find it
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "code" / "cleaning"))
+clean_tse_data = importlib.import_module("01_clean_tse_data")
+
+
+def reference_esteban_ray(vote_shares, ideologies, alpha=1.6):
+    """Original O(n^2) double loop, kept as the ground truth"""
+    mask = vote_shares > 0
+    vote_shares = vote_shares[mask]
+    ideologies = ideologies[mask]
+    vote_shares = vote_shares / vote_shares.sum()
+
+    polarization = 0
+    n = len(vote_shares)
+    for i in range(n):
+        for j in range(n):
+            if i != j:
+                polarization += (
+                    vote_shares[i] ** (1 + alpha) *
+                    vote_shares[j] *
+                    abs(ideologies[i] - ideologies[j])
+                )
+    return polarization
+
+
+@pytest.mark.parametrize("use_numba", [True, False])
+def test_municipality_without_votes_gets_zero_polarization(monkeypatch, use_numba):
+    if use_numba and not clean_tse_data.NUMBA_AVAILABLE:
+        pytest.skip("numba not installed")
+    monkeypatch.setattr(clean_tse_data, "NUMBA_AVAILABLE", use_numba)
+
+    votes_df = pd.DataFrame({
+        'CD_MUNICIPIO': [10, 10, 20, 20, 20],
+        'SG_PARTIDO': ['PT', 'PSDB', 'PT', 'PSDB', 'NOVO'],
+        'QT_VOTOS': [0, 0, 50, 30, 20]
+    })
+    ideology_df = pd.DataFrame({
+        'party': ['PT', 'PSDB', 'NOVO'],
+        'ideology': [2.0, 6.0, 9.0],
+        'year': [2018, 2018, 2018]
+    })
+
+    result = clean_tse_data.calculate_municipality_polarization(
+        votes_df, ideology_df, 2018
+    ).set_index('cod_municipio')
+
+    assert result.loc[10, 'polarizacao_er'] == 0.0
+    assert result.loc[20, 'polarizacao_er'] == pytest.approx(
+        reference_esteban_ray(np.array([0.5, 0.3, 0.2]), np.array([2.0, 6.0, 9.0])),
+        rel=1e-5
+    )
+
+
+def test_esteban_ray_index_matches_double_loop():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        n = rng.integers(1, 15)
+        shares = rng.random(n)
+        shares[rng.random(n) < 0.2] = 0
+        # Rounded so that some parties tie on ideology
+        ideologies = np.round(rng.uniform(0, 10, n))
+        assert clean_tse_data.esteban_ray_index(shares, ideologies) == pytest.approx(
+            reference_esteban_ray(shares, ideologies), rel=1e-5, abs=1e-7
+        )
+
+
+@pytest.mark.parametrize("shares", [np.zeros(2), np.array([np.nan, np.nan])])
+def test_esteban_ray_index_without_votes_is_zero(shares):
+    assert clean_tse_data.esteban_ray_index(shares, np.array([1.0, 2.0])) == 0.0
+
+
+@pytest.mark.parametrize("use_numba", [True, False])
+def test_single_ideology_split_over_rows_is_exactly_zero(monkeypatch, use_numba):
+    if use_numba and not clean_tse_data.NUMBA_AVAILABLE:
+        pytest.skip("numba not installed")
+    monkeypatch.setattr(clean_tse_data, "NUMBA_AVAILABLE", use_numba)
+
+    # One party reported across several zones: the prefix sums must not
+    # leave rounding noise behind
+    votes_df = pd.DataFrame({
+        'CD_MUNICIPIO': [30, 30, 30],
+        'SG_PARTIDO': ['PSTU', 'PSTU', 'PSTU'],
+        'QT_VOTOS': [4, 284, 17]
+    })
+    ideology_df = pd.DataFrame({
+        'party': ['PSTU'],
+        'ideology': [0.51],
+        'year': [2018]
+    })
+
+    result = clean_tse_data.calculate_municipality_polarization(
+        votes_df, ideology_df, 2018
+    )
+
+    assert result['polarizacao_er'].tolist() == [0.0]
+
+
+def _year_results(year, polarization):
+    return pd.DataFrame({
+        'cod_municipio': np.array([20, 10], dtype=np.int64),
+        'ano': np.full(2, year, dtype=np.int16),
+        'polarizacao_er': polarization,
+        'num_partidos': np.array([3, 2], dtype=np.int32),
+        'total_votos': np.array([100, 0], dtype=np.int64)
+    })
+
+
+@pytest.mark.skipif(not clean_tse_data.PYARROW_AVAILABLE, reason="pyarrow not installed")
+def test_partitioned_dataset_round_trip_matches_pandas_csv(tmp_path):
+    dataset_path = tmp_path / "tse_cleaned"
+    years = {
+        2018: _year_results(2018, [0.1234, 0.0]),
+        2022: _year_results(2022, [1.5e-07, 1.0])
+    }
+
+    # A rerun of a year replaces its partition instead of appending to it
+    clean_tse_data.save_year_partition(_year_results(2018, [9.0, 9.0]), dataset_path)
+    for polarization_df in years.values():
+        clean_tse_data.save_year_partition(polarization_df, dataset_path)
+
+    output_path = tmp_path / "tse_cleaned.csv"
+    final_df = clean_tse_data.export_dataset_csv(dataset_path, output_path)
+
+    expected_path = tmp_path / "expected.csv"
+    pd.concat(years.values(), ignore_index=True).sort_values(
+        ['cod_municipio', 'ano']
+    ).to_csv(expected_path, index=False, encoding='utf-8')
+
+    assert sorted(p.name for p in dataset_path.iterdir()) == ['ano=2018', 'ano=2022']
+    assert output_path.read_text() == expected_path.read_text()
+    assert len(final_df) == 4
+
+
+@pytest.mark.parametrize("reader", ["polars", "pyarrow", "pandas"])
+def test_load_tse_data_filters_and_caches(monkeypatch, tmp_path, reader):
+    if reader == "polars" and not clean_tse_data.POLARS_AVAILABLE:
+        pytest.skip("polars not installed")
+    if reader == "pyarrow" and not clean_tse_data.PYARROW_AVAILABLE:
+        pytest.skip("pyarrow not installed")
+    monkeypatch.setattr(clean_tse_data, "POLARS_AVAILABLE", reader == "polars")
+    monkeypatch.setattr(clean_tse_data, "PYARROW_AVAILABLE", reader == "pyarrow")
+    monkeypatch.setattr(clean_tse_data, "RAW_DATA_PATH", tmp_path / "raw")
+    monkeypatch.setattr(clean_tse_data, "PROCESSED_DATA_PATH", tmp_path / "processed")
+    (tmp_path / "raw").mkdir()
+    (tmp_path / "processed").mkdir()
+
+    # Quoted, semicolon-separated Latin1 like the TSE downloads
+    raw_path = tmp_path / "raw" / "votacao_candidato_munzona_2018.csv"
+    pd.DataFrame({
+        'DT_GERACAO': ['01/01/2019'] * 6,
+        'DS_CARGO': ['Presidente', 'Presidente', 'Governador', 'Presidente', 'Presidente', 'Presidente'],
+        'NR_TURNO': [1, 1, 1, 2, 1, 1],
+        'CD_MUNICIPIO': [10, 10, 10, 10, 20, 20],
+        'NM_MUNICIPIO': ['São Paulo'] * 6,
+        'SG_PARTIDO': ['PT', 'PSDB', 'PT', 'PT', 'PT', 'NOVO'],
+        'QT_VOTOS': [5, 3, 9, 9, 2, 2]
+    }).to_csv(raw_path, sep=';', index=False, encoding='latin1', quoting=1)
+    expected = {
+        'CD_MUNICIPIO': [10, 10, 20, 20],
+        'SG_PARTIDO': ['PT', 'PSDB', 'PT', 'NOVO'],
+        'QT_VOTOS': [5, 3, 2, 2]
+    }
+
+    def loaded():
+        df = clean_tse_data.load_tse_data(2018)
+        return df[clean_tse_data.VOTE_COLUMNS].astype({'SG_PARTIDO': str}).to_dict('list')
+
+    assert loaded() == expected
+
+    cache_path = tmp_path / "processed" / "votes_2018.parquet"
+    assert cache_path.exists() == (reader != "pandas")
+    if reader != "pandas":
+        # With the raw file gone, only the cache can provide the votes
+        raw_path.unlink()
+        assert loaded() == expected